@@ -1,118 +1,351 @@
-import requests
-import time
+import asyncio
+import aiohttp
+import csv
+import math
+import orjson # Décodage JSON rapide (implémenté en C)
+import os
+import re
+import sqlite3
 import sys # Pour afficher les erreurs sur stderr
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 
 # --- Configuration ---
 input_filename = "data/GWAS_sign_SNP.txt"
 output_filename = "data/snp_coordinates_grch37.tsv"
 api_url_base = "http://grch37.rest.ensembl.org/variation/homo_sapiens"
-# Temps de pause entre les requêtes (en secondes) pour respecter le serveur
-sleep_time = 0.5
+# Nombre maximum de rsIDs par requête POST (limite de l'API Ensembl)
+batch_size = 200
+# Nombre maximum de requêtes simultanées (remplace la pause fixe entre les requêtes)
+max_concurrent_requests = 5
+# Nouvelles tentatives en cas d'erreur temporaire, avec attente exponentielle
+# (backoff_factor * 2^tentative secondes, ou l'en-tête Retry-After s'il est présent)
+max_retries = 5
+backoff_factor = 0.5
+retry_statuses = {429, 500, 502, 503, 504}
+# Délai maximum accepté (en secondes) depuis un en-tête Retry-After / X-RateLimit-Reset ;
+# au-delà (ou valeur non finie), on utilise l'attente par défaut
+max_delay = 300
+# Limites du pool de connexions (total et par hôte)
+connection_limit = 8
+connection_limit_per_host = 5
+# Durée (en secondes) pendant laquelle une connexion inactive reste ouverte pour être réutilisée
+keepalive_timeout = 30
+# En-têtes communs à toutes les requêtes (définis une seule fois sur la session)
+request_headers = {"Content-Type": "application/json", "Accept": "application/json"}
+# En-tête du fichier de sortie
+output_header = ("rsID", "Chromosome", "Position_GRCh37")
+# Taille du tampon d'écriture du fichier de sortie (1 Mio) et fréquence de vidage sur disque
+write_buffer_size = 1 << 20
+flush_every = 500
+# Cache persistant des réponses Ensembl (une entrée par rsID) pour éviter de tout
+# ré-interroger à chaque exécution
+cache_filename = "data/ensembl_cache.sqlite"
+cache_expire_after = timedelta(days=30)
+# Nombre maximum de rsIDs par requête de lecture du cache
+cache_query_size = 500
 # --- Fin Configuration ---
 
-# Compteurs pour le résumé
-count_success = 0
-count_fail = 0
-
-# Essayer d'ouvrir les fichiers
-try:
-    infile = open(input_filename, 'r')
-except FileNotFoundError:
-    print(f"ERREUR: Le fichier d'input '{input_filename}' n'a pas été trouvé!", file=sys.stderr)
-    sys.exit(1) # Arrêter le script
-
-try:
-    outfile = open(output_filename, 'w')
-except IOError:
-    print(f"ERREUR: Impossible d'écrire dans le fichier de sortie '{output_filename}'!", file=sys.stderr)
-    infile.close()
-    sys.exit(1)
 
+def open_cache(path):
+    """Ouvre (ou crée) le cache SQLite des réponses Ensembl."""
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS responses (rsid TEXT PRIMARY KEY, fetched_at REAL, data TEXT)")
+    return conn
 
-# Écrire l'en-tête dans le fichier de sortie
-outfile.write("rsID\tChromosome\tPosition_GRCh37\n")
 
-print(f"Lecture des rsIDs depuis '{input_filename}'...")
-print(f"Écriture des coordonnées GRCh37 dans '{output_filename}'...")
+def load_cached(conn, rsids):
+    """
+    Retourne un dict {rsid: entrée JSON} des rsIDs présents dans le cache et non expirés.
+    """
+    cutoff = time.time() - cache_expire_after.total_seconds()
+    cached = {}
+    # Interroger uniquement les rsIDs demandés, par paquets (limite du nombre de paramètres SQLite)
+    for i in range(0, len(rsids), cache_query_size):
+        keys = rsids[i:i + cache_query_size]
+        placeholders = ",".join("?" * len(keys))
+        query = f"SELECT rsid, data FROM responses WHERE fetched_at >= ? AND rsid IN ({placeholders})"
+        for rsid, data in conn.execute(query, (cutoff, *keys)):
+            cached[rsid] = orjson.loads(data)
+    return cached
 
-# Lire chaque ligne (rsID) du fichier d'input
-for line in infile:
-    rsid = line.strip() # Enlever les espaces/retours à la ligne
 
-    if not rsid: # Ignorer les lignes vides
-        continue
+def store_cached(conn, entries):
+    """Enregistre dans le cache les entrées JSON {rsid: entrée} reçues d'Ensembl."""
+    now = time.time()
+    conn.executemany("INSERT OR REPLACE INTO responses (rsid, fetched_at, data) VALUES (?, ?, ?)",
+                     ((rsid, now, orjson.dumps(entry)) for rsid, entry in entries.items()))
+    conn.commit()
 
-    print(f"Traitement de {rsid} ... ", end="")
 
-    request_url = f"{api_url_base}/{rsid}?content-type=application/json"
+def parse_coordinates(rsid, data):
+    """
+    Extrait les coordonnées GRCh37 de l'entrée JSON Ensembl d'un rsID.
+    Retourne un tuple (rsid, chromosome, position, ok).
+    """
+    # Essayer d'extraire les coordonnées GRCh37
+    # On essaie d'abord au niveau racine, puis dans le premier mapping si nécessaire
+    # (simples .get plutôt que try/except : pas d'exception levée pour chaque rsID)
+    chromosome = data.get('seq_region_name')
+    position = data.get('start')
+    if chromosome is None or position is None:
+        mapping = (data.get('mappings') or [{}])[0]
+        chromosome = mapping.get('seq_region_name')
+        position = mapping.get('start')
 
-    chromosome = "NA"
-    position = "NA"
+    if chromosome is None or position is None:
+        # Si 'mappings' est absent ou vide, on ne trouve pas les coordonnées
+        print(f"{rsid} : Échec (Structure JSON inattendue ou coordonnées manquantes).")
+        return rsid, "PARSE_ERROR", "PARSE_ERROR", False
+
+    # Si on a réussi à extraire chromosome et position
+    print(f"{rsid} : OK ({chromosome}:{position})")
+    return rsid, chromosome, position, True
 
-    try:
-        # Faire la requête à l'API Ensembl
-        response = requests.get(request_url, headers={"Content-Type": "application/json"}, timeout=10) # Timeout de 10s
 
-        # Vérifier si la requête a échoué (ex: 404 Not Found si rsid inconnu)
-        response.raise_for_status() # Lève une exception pour les erreurs HTTP
+def read_done_rows(path):
+    """
+    Lit un fichier de sortie existant (exécution précédente interrompue).
+    Retourne la liste des lignes déjà résolues [rsid, chromosome, position] ;
+    les lignes 'NA' (erreur réseau ou rsID non trouvé) sont écartées pour être ré-essayées,
+    de même que les lignes incomplètes (dernière ligne tronquée par un arrêt brutal).
+    """
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'r', newline='') as f:
+        lines = f.read().split('\n')
+    # Le dernier élément est vide si le fichier se termine par '\n' ; sinon c'est une ligne tronquée
+    lines.pop()
+    return [row for row in csv.reader(lines, delimiter='\t')
+            if len(row) == 3 and row[0] != "rsID" and row[1] not in ("", "NA")
+            and (row[2].isdigit() or row[1] == row[2] == "PARSE_ERROR")]
 
-        # Si la requête réussit (status code 200)
-        data = response.json()
 
-        # Essayer d'extraire les coordonnées GRCh37
-        # On essaie d'abord au niveau racine, puis dans 'mappings' si nécessaire
+def parse_delay(value, default):
+    """
+    Convertit un en-tête de délai (nombre de secondes ou date HTTP, cf. Retry-After)
+    en secondes ; retourne default si l'en-tête est absent, illisible, non fini
+    ou supérieur à max_delay.
+    """
+    if value is None:
+        return default
+    try:
+        delay = float(value)
+    except ValueError:
         try:
-            chromosome = data['seq_region_name']
-            position = data['start']
-        except KeyError:
-             # Si pas au niveau racine, essayer dans le premier mapping
+            retry_at = parsedate_to_datetime(value)
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=timezone.utc)
+            delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return default
+    if not math.isfinite(delay) or delay > max_delay:
+        return default
+    return max(0.0, delay)
+
+
+async def wait_for_rate_limit(response):
+    """
+    Respecte les en-têtes de limitation de débit d'Ensembl :
+    attend la réinitialisation du quota si celui-ci est épuisé.
+    Les en-têtes absents ou illisibles sont ignorés.
+    """
+    try:
+        remaining = int(response.headers.get("X-RateLimit-Remaining", ""))
+    except ValueError:
+        return
+    reset = parse_delay(response.headers.get("X-RateLimit-Reset"), None)
+    if reset is not None and remaining <= 0:
+        print(f"Quota Ensembl épuisé, pause de {reset}s...")
+        await asyncio.sleep(reset)
+
+
+async def fetch_batch(session, sem, chunk):
+    """
+    Récupère les entrées Ensembl d'un lot de rsIDs (au plus batch_size)
+    en une seule requête POST à l'API Ensembl.
+    Retourne un tuple (lot, dict {rsid: entrée JSON}), le dict valant None si la requête a échoué.
+    """
+    # Le sémaphore limite le nombre de requêtes en vol pour respecter le serveur
+    async with sem:
+        for attempt in range(max_retries + 1):
             try:
-                mapping = data.get('mappings') # Utilise .get pour éviter KeyError si 'mappings' n'existe pas
-                if mapping and isinstance(mapping, list) and len(mapping) > 0:
-                     chromosome = mapping[0]['seq_region_name']
-                     position = mapping[0]['start']
-                else:
-                     # Si 'mappings' est absent ou vide, on ne trouve pas les coordonnées
-                      raise KeyError # Provoque le passage au bloc except extérieur
-            except (KeyError, IndexError, TypeError):
-                print("Échec (Structure JSON inattendue ou coordonnées manquantes).")
+                # Faire la requête à l'API Ensembl
+                async with session.post(api_url_base, json={"ids": chunk},
+                                        timeout=aiohttp.ClientTimeout(total=60)) as response: # Timeout de 60s par lot
+
+                    # Erreur temporaire (trop de requêtes, serveur surchargé...) : réessayer
+                    if response.status in retry_statuses and attempt < max_retries:
+                        # Respecter le délai indiqué par le serveur, sinon attente exponentielle
+                        delay = parse_delay(response.headers.get("Retry-After"), backoff_factor * 2 ** attempt)
+                        print(f"Lot de {len(chunk)} rsIDs ({chunk[0]}...) : HTTP {response.status}, nouvel essai dans {delay}s...")
+                        await asyncio.sleep(delay)
+                        continue
+
+                    # Vérifier si la requête a échoué
+                    response.raise_for_status() # Lève une exception pour les erreurs HTTP
+
+                    # Si la requête réussit (status code 200) : {rsid: {...}, ...}
+                    data = orjson.loads(await response.read())
+                    await wait_for_rate_limit(response)
+                    break
+
+            except aiohttp.ClientResponseError as http_err:
+                # Gérer les erreurs HTTP définitives : tout le lot est en échec
+                print(f"Lot de {len(chunk)} rsIDs ({chunk[0]}...) : Échec (Erreur HTTP: {http_err.status} {http_err.message})")
+                return chunk, None
+
+            except (aiohttp.ClientError, asyncio.TimeoutError, orjson.JSONDecodeError) as req_err:
+                # Gérer les autres erreurs de requête (connexion, timeout, réponse qui n'est pas du JSON...) :
+                # réessayer avec attente exponentielle
+                if attempt < max_retries:
+                    delay = backoff_factor * 2 ** attempt
+                    print(f"Lot de {len(chunk)} rsIDs ({chunk[0]}...) : Erreur Requête ({req_err!r}), nouvel essai dans {delay}s...")
+                    await asyncio.sleep(delay)
+                    continue
+                print(f"Lot de {len(chunk)} rsIDs ({chunk[0]}...) : Échec (Erreur Requête: {req_err!r})")
+                return chunk, None
+
+    return chunk, data
+
+
+async def main():
+    # Compteurs pour le résumé
+    count_success = 0
+    count_fail = 0
+
+    # Essayer d'ouvrir le fichier d'input
+    try:
+        infile = open(input_filename, 'r')
+    except FileNotFoundError:
+        print(f"ERREUR: Le fichier d'input '{input_filename}' n'a pas été trouvé!", file=sys.stderr)
+        sys.exit(1) # Arrêter le script
+
+    print(f"Lecture des rsIDs depuis '{input_filename}'...")
+
+    # Lire chaque ligne (rsID) du fichier d'input, en ignorant les lignes vides et les commentaires ;
+    # les doublons sont retirés (en conservant l'ordre du fichier) pour ne pas les interroger deux fois
+    lines = [line.strip() for line in infile]
+    infile.close()
+    lines = [line for line in lines if line and not line.startswith('#')]
+    candidates = list(dict.fromkeys(lines))
+
+    rsids = []
+    for rsid in candidates:
+        if re.fullmatch(r"rs\d+", rsid):
+            rsids.append(rsid)
+        else:
+            print(f"AVERTISSEMENT: Identifiant invalide ignoré : '{rsid}'", file=sys.stderr)
+    count_duplicates = len(lines) - len(candidates)
+    if count_duplicates:
+        print(f"{count_duplicates} doublon(s) ignoré(s).")
+
+    # Reprise : les rsIDs déjà résolus lors d'une exécution précédente sont sautés
+    # (seulement ceux qui figurent encore dans l'input : les autres lignes sont retirées du fichier)
+    wanted = set(rsids)
+    done_rows = []
+    done = set()
+    for row in read_done_rows(output_filename):
+        if row[0] in wanted and row[0] not in done:
+            done_rows.append(row)
+            done.add(row[0])
+    pending = [rsid for rsid in rsids if rsid not in done]
+    if done:
+        print(f"{len(done)} rsIDs déjà résolus dans '{output_filename}', reprise avec les {len(pending)} restants.")
+
+    try:
+        if os.path.isfile(output_filename) and os.path.getsize(output_filename) > 0:
+            # Réécrire le fichier sans les anciennes lignes 'NA', qui vont être ré-essayées,
+            # ni les rsIDs qui ne sont plus dans l'input
+            with open(output_filename, 'w', newline='') as f:
+                writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+                writer.writerow(output_header)
+                writer.writerows(row[:3] for row in done_rows)
+        # Grand tampon d'écriture : moins d'appels système qu'un fichier tamponné par ligne
+        outfile = open(output_filename, 'a', buffering=write_buffer_size, newline='')
+    except IOError:
+        print(f"ERREUR: Impossible d'écrire dans le fichier de sortie '{output_filename}'!", file=sys.stderr)
+        sys.exit(1)
+
+    writer = csv.writer(outfile, delimiter='\t', lineterminator='\n')
+
+    # Écrire l'en-tête seulement si le fichier de sortie est nouveau
+    if os.path.getsize(output_filename) == 0:
+        writer.writerow(output_header)
+
+    print(f"Écriture des coordonnées GRCh37 dans '{output_filename}'...")
+
+    rows_since_flush = 0
+
+    def write_rows(rows):
+        # Les lignes sont écrites au fil de l'eau et le fichier vidé sur disque toutes les
+        # flush_every lignes ; les réponses déjà reçues restent de toute façon dans le cache
+        nonlocal count_success, count_fail, rows_since_flush
+        for rsid, chromosome, position, ok in rows:
+            writer.writerow((rsid, chromosome, position))
+            rows_since_flush += 1
+            if ok:
+                count_success += 1
+            else:
                 count_fail += 1
-                outfile.write(f"{rsid}\tPARSE_ERROR\tPARSE_ERROR\n")
-                time.sleep(sleep_time) # Pause même en cas d'erreur de parsing
-                continue # Passer au rsID suivant
-
-        # Si on a réussi à extraire chromosome et position
-        print(f"OK ({chromosome}:{position})")
-        outfile.write(f"{rsid}\t{chromosome}\t{position}\n")
-        count_success += 1
-
-    except requests.exceptions.HTTPError as http_err:
-        # Gérer les erreurs HTTP (ex: 404 Not Found)
-        print(f"Échec (Erreur HTTP: {http_err})")
-        count_fail += 1
-        # Pas besoin d'écrire ici, car 'NA' sont les valeurs par défaut
-
-    except requests.exceptions.RequestException as req_err:
-        # Gérer les autres erreurs de requête (connexion, timeout...)
-        print(f"Échec (Erreur Requête: {req_err})")
-        count_fail += 1
-        # Pas besoin d'écrire ici
-
-    # Écrire les NA si une erreur HTTP ou RequestException s'est produite avant l'extraction
-    if chromosome == "NA":
-         outfile.write(f"{rsid}\t{chromosome}\t{position}\n")
-
-    # Pause pour être respectueux envers le serveur Ensembl
-    time.sleep(sleep_time)
-
-# Fermer les fichiers
-infile.close()
-outfile.close()
-
-print("\n-----------------------------------------------------")
-print("Terminé.")
-print(f"Succès: {count_success}")
-print(f"Échecs/Non trouvés/Erreurs: {count_fail}")
-print(f"Résultats sauvegardés dans : '{output_filename}'")
-print("Veuillez vérifier le fichier de sortie.")
-print("-----------------------------------------------------")
\ No newline at end of file
+        if rows_since_flush >= flush_every:
+            outfile.flush()
+            rows_since_flush = 0
+
+    # Les rsIDs déjà présents dans le cache ne sont pas ré-interrogés
+    cache = open_cache(cache_filename)
+    entries = load_cached(cache, pending)
+    to_fetch = [rsid for rsid in pending if rsid not in entries]
+    print(f"{len(entries)} rsIDs trouvés dans le cache '{cache_filename}'.")
+    write_rows([parse_coordinates(rsid, entries[rsid]) for rsid in pending if rsid in entries])
+
+    # Découper la liste en lots de batch_size rsIDs
+    chunks = [to_fetch[i:i + batch_size] for i in range(0, len(to_fetch), batch_size)]
+
+    print(f"Interrogation de l'API Ensembl pour {len(to_fetch)} rsIDs en {len(chunks)} lot(s) ({max_concurrent_requests} requêtes simultanées)...")
+
+    sem = asyncio.Semaphore(max_concurrent_requests)
+    # Une seule session pour tout le script : les connexions TCP sont conservées (keep-alive)
+    # et la résolution DNS mise en cache, la poignée de main n'est payée qu'à la première requête
+    connector = aiohttp.TCPConnector(limit=connection_limit, limit_per_host=connection_limit_per_host,
+                                     keepalive_timeout=keepalive_timeout, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector, headers=request_headers) as session:
+        # Traiter chaque lot dès qu'il est terminé
+        for next_batch in asyncio.as_completed([fetch_batch(session, sem, chunk) for chunk in chunks]):
+            chunk, data = await next_batch
+            if data is None:
+                write_rows((rsid, "NA", "NA", False) for rsid in chunk)
+                continue
+
+            # Seules les réponses valides sont mises en cache
+            store_cached(cache, data)
+
+            rows = []
+            for rsid in chunk:
+                if rsid in data:
+                    rows.append(parse_coordinates(rsid, data[rsid]))
+                else:
+                    # Les rsIDs inconnus sont simplement absents de la réponse
+                    print(f"{rsid} : Échec (Non trouvé)")
+                    rows.append((rsid, "NA", "NA", False))
+            write_rows(rows)
+
+    cache.close()
+
+    # Fermer le fichier de sortie
+    outfile.close()
+
+    print("\n-----------------------------------------------------")
+    print("Terminé.")
+    print(f"Succès: {count_success}")
+    print(f"Échecs/Non trouvés/Erreurs: {count_fail}")
+    if done:
+        print(f"Déjà résolus lors d'une exécution précédente: {len(done)}")
+    print(f"Résultats sauvegardés dans : '{output_filename}'")
+    print("Veuillez vérifier le fichier de sortie.")
+    print("-----------------------------------------------------")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
+import hashlib
 import os
 import sys
+import shutil
 import subprocess
 import csv
+import contextlib
+import pandas as pd
+import urllib.request
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # === Configuration (Adapt if necessary!) ===
 
@@ -28,45 +35,115 @@ VCF_FILENAME_TEMPLATE = "ALL.chr{CHROMOSOME}.phase3_shapeit2_mvncall_integrated_
 # Command for bcftools (Use the full path if needed)
 BCFTOOLS_CMD = "/opt/anaconda3/envs/bcftools/bin/bcftools" # <--- PUT THE PATH FOUND WITH 'which bcftools' HERE
 
+# Number of extra threads bcftools uses for BGZF (de)compression
+BCFTOOLS_THREADS = 4
+
 # Size of the window around the position in the TSV file (e.g., 5000 means Position +/- 5000 bp)
 REGION_WINDOW_SIZE = 10000
 
 # Directory to store output VCF files
 OUTPUT_DIR = "output_vcfs"
 
+# Number of chromosomes fetched in parallel from the 1000 Genomes server
+# (each bcftools process is mostly waiting on the network)
+MAX_PARALLEL_DOWNLOADS = 8
+
+# Local cache for the remote VCF indexes (.tbi), downloaded once per chromosome
+INDEX_CACHE_DIR = "vcf_index_cache"
+
+# Sub-directory of OUTPUT_DIR for the intermediate per-chromosome extractions
+# (kept out of OUTPUT_DIR itself so that downstream scripts only see per-rsID VCFs)
+CHROMOSOME_DIR = os.path.join(OUTPUT_DIR, "by_chromosome")
+
 # === Helper Functions ===
 
+# awk program used by extract_samples: locate the 'sample' and 'super_pop' columns
+# from the header, then print the sample ID of every row of the target population.
+# Exits with status 2 if one of the columns is missing.
+AWK_EXTRACT_SAMPLES = (
+    'NR==1 { for (i = 1; i <= NF; i++) h[$i] = i; '
+    'if (!("sample" in h) || !("super_pop" in h)) exit 2; next } '
+    '$h["super_pop"] == pop { print $h["sample"] }'
+)
+
+def extract_samples_python(panel_file, population_code, samples_output_file):
+    """
+    Pure Python fallback for extract_samples (used when awk is not available).
+    Returns the count of samples found.
+    """
+    sample_count = 0
+    with open(panel_file, 'r') as infile, open(samples_output_file, 'w') as outfile:
+        reader = csv.reader(infile, delimiter='\t')
+        header = next(reader) # Skip header
+        # Find column indices (more robust than assuming fixed positions)
+        try:
+            sample_col_idx = header.index('sample') # or the actual header name for sample ID
+            pop_col_idx = header.index('super_pop') # or the actual header name for super population
+        except ValueError as e:
+            print(f"ERROR: Missing expected column in panel file header: {e}")
+            print(f"Expected columns like 'sample' and 'super_pop'. Found: {header}")
+            sys.exit(1)
+
+        for row in reader:
+             # Check row length before accessing indices
+             if len(row) > max(sample_col_idx, pop_col_idx) and row[pop_col_idx] == population_code:
+                outfile.write(row[sample_col_idx] + '\n')
+                sample_count += 1
+    return sample_count
+
+
 def extract_samples(panel_file, population_code, samples_output_file):
     """
     Extracts sample IDs for a specific population from the panel file.
+    Uses a single awk process when available, otherwise falls back to Python.
     Returns the count of samples found.
     """
     print(f"\n--- Step 2: Extracting {population_code} sample IDs ---")
-    sample_count = 0
+    # Skip the extraction if the samples file was already generated from the same
+    # panel file (same modification time) and population
+    key_file = samples_output_file + ".key"
     try:
-        with open(panel_file, 'r') as infile, open(samples_output_file, 'w') as outfile:
-            reader = csv.reader(infile, delimiter='\t')
-            header = next(reader) # Skip header
-            # Find column indices (more robust than assuming fixed positions)
-            try:
-                sample_col_idx = header.index('sample') # or the actual header name for sample ID
-                pop_col_idx = header.index('super_pop') # or the actual header name for super population
-            except ValueError as e:
-                print(f"ERROR: Missing expected column in panel file header: {e}")
-                print(f"Expected columns like 'sample' and 'super_pop'. Found: {header}")
-                sys.exit(1)
+        key = hashlib.md5(f"{os.path.getmtime(panel_file)}:{population_code}".encode()).hexdigest()
+    except OSError:
+        key = None
+    if key and os.path.isfile(samples_output_file) and os.path.isfile(key_file):
+        with open(key_file, 'r') as f:
+            if f.read().strip() == key:
+                with open(samples_output_file, 'r') as samples:
+                    sample_count = sum(1 for _ in samples)
+                if sample_count > 0:
+                    print(f"Samples file {samples_output_file} is up to date ({sample_count} {population_code} IDs), skipping extraction.")
+                    return sample_count
 
-            for row in reader:
-                 # Check row length before accessing indices
-                 if len(row) > max(sample_col_idx, pop_col_idx) and row[pop_col_idx] == population_code:
-                    outfile.write(row[sample_col_idx] + '\n')
-                    sample_count += 1
+    try:
+        awk_cmd = shutil.which("awk")
+        if awk_cmd is None:
+            print("awk not found, extracting samples with Python.")
+            sample_count = extract_samples_python(panel_file, population_code, samples_output_file)
+        else:
+            if not os.path.isfile(panel_file):
+                raise FileNotFoundError(panel_file)
+            with open(samples_output_file, 'w') as outfile:
+                result = subprocess.run(
+                    [awk_cmd, "-F", "\t", "-v", f"pop={population_code}", AWK_EXTRACT_SAMPLES, panel_file],
+                    stdout=outfile, stderr=subprocess.PIPE, text=True
+                )
+            if result.returncode == 2:
+                print("ERROR: Missing expected column in panel file header.")
+                print("Expected columns like 'sample' and 'super_pop'.")
+                sys.exit(1)
+            elif result.returncode != 0:
+                raise RuntimeError(f"awk exited with code {result.returncode}: {result.stderr.strip()}")
+            with open(samples_output_file, 'r') as f:
+                sample_count = sum(1 for _ in f)
 
         if sample_count > 0:
             print(f"Extraction successful. {sample_count} {population_code} IDs saved to {samples_output_file}")
+            with open(key_file, 'w') as f:
+                f.write(key + '\n')
             return sample_count
         else:
-            print(f"ERROR: No samples found for {population_code} in '{panel_file}' (check column {pop_col_idx+1} and population code).")
+            print(f"ERROR: No samples found for {population_code} in '{panel_file}' (check the 'super_pop' column and population code).")
             sys.exit(1)
 
     except FileNotFoundError:
@@ -77,48 +154,30 @@ def extract_samples(panel_file, population_code, samples_output_file):
         sys.exit(1)
 
 
-def run_bcftools(bcftools_cmd, vcf_url_for_chr, region, samples_file, output_vcf_file):
+def run_bcftools_command(bcftools_cmd, command, description, source, samples_file=None, input_text=None):
     """
-    Runs the bcftools view command for a specific region and sample set,
-    using the VCF URL appropriate for the chromosome in the region.
+    Runs a bcftools command, reporting errors for the given description.
+    input_text, if given, is sent to the command on stdin.
+    Returns True on success, False on failure.
     """
-    print(f"\n--- Step 3: Extracting region {region} with bcftools ---")
-    print(f"  Region target (GRCh37): {region}")
-    # Note: vcf_url_for_chr is now specific to the chromosome being processed
-    print(f"  VCF source (GRCh37): {vcf_url_for_chr}")
-    print(f"  Target samples: {samples_file}")
-    print(f"  Output file: {output_vcf_file}")
-
-    command = [
-        bcftools_cmd,
-        "view",
-        vcf_url_for_chr, # Use the dynamically generated URL passed to this function
-        "-r", region,
-        "-S", samples_file,
-        "-O", "z",         # Output compressed VCF
-        "-o", output_vcf_file
-    ]
-
     try:
-        # Ensure output directory exists
-        os.makedirs(os.path.dirname(output_vcf_file), exist_ok=True)
-
         # Run bcftools command
-        result = subprocess.run(command, check=False, capture_output=True, text=True) # Use check=False to handle errors manually
+        result = subprocess.run(command, input=input_text, check=False, capture_output=True, text=True) # Use check=False to handle errors manually
 
         # Check if bcftools failed
         if result.returncode != 0:
-            print(f"ERROR: bcftools failed for region {region}.")
+            print(f"ERROR: bcftools failed for {description}.")
             print(f"  Return Code: {result.returncode}")
             print(f"  Stderr: {result.stderr.strip()}") # Strip whitespace from stderr
             print(f"  Stdout: {result.stdout.strip()}") # Strip whitespace from stdout
-            print("  Check VCF URL (is it valid for this chromosome? is the server accessible?), region format,")
-            print("  existence of the index (.tbi) on the server for this chromosome file,")
-            print(f"  and the sample file ('{samples_file}').")
-            # Indicate failure for this region
+            print(f"  Check VCF source ('{source}': is it valid for this chromosome? is the server accessible?), region format,")
+            print("  and existence of the index (.tbi) for this chromosome file.")
+            if samples_file:
+                print(f"  Also check the sample file ('{samples_file}').")
+            # Indicate failure
             return False
         else:
-            print(f"bcftools extraction completed successfully for region {region}.")
+            print(f"bcftools completed successfully for {description}.")
             # bcftools might print non-error info to stderr (e.g., index loading messages)
             if result.stderr:
                  print(f"  bcftools stderr output:\n{result.stderr.strip()}")
@@ -130,10 +189,294 @@ def run_bcftools(bcftools_cmd, vcf_url_for_chr, region, samples_file, output_vcf
         print("  Please ensure bcftools is installed and the path in BCFTOOLS_CMD is correct.")
         sys.exit(1) # Exit here as bcftools is fundamental
     except Exception as e:
-        print(f"ERROR: An unexpected error occurred while running bcftools for region {region}: {e}")
-        # Indicate failure for this region
+        print(f"ERROR: An unexpected error occurred while running bcftools for {description}: {e}")
+        # Indicate failure
         return False
 
+
+def merge_intervals(intervals):
+    """
+    Merges overlapping or adjacent (start, end) intervals (1-based, inclusive).
+    Returns the merged intervals sorted by start position.
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(interval) for interval in merged]
+
+
+def format_regions(chromosome, intervals):
+    """
+    Formats (start, end) intervals (1-based, inclusive) for one chromosome as a
+    tab-delimited CHROM/BEG/END region list, as read by 'bcftools view -R'.
+    """
+    return "".join(f"{chromosome}\t{start}\t{end}\n" for start, end in intervals)
+
+
+def fetch_remote_index(vcf_url, cache_dir):
+    """
+    Downloads the .tbi index of a remote VCF into cache_dir (once; later runs reuse it).
+    Returns the local index path, or None if it could not be downloaded
+    (bcftools then falls back to fetching the remote index itself).
+    """
+    local_index = os.path.join(cache_dir, os.path.basename(vcf_url) + ".tbi")
+    if os.path.isfile(local_index):
+        print(f"  Using cached index: {local_index}")
+        return local_index
+
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        # Download to a temporary name first so an interrupted download is never reused
+        urllib.request.urlretrieve(vcf_url + ".tbi", local_index + ".part")
+        os.replace(local_index + ".part", local_index)
+        print(f"  Downloaded index: {local_index}")
+        return local_index
+    except Exception as e:
+        print(f"WARNING: Could not download index '{vcf_url}.tbi': {e}")
+        return None
+
+
+def fetch_chromosome_regions(bcftools_cmd, vcf_url_for_chr, chromosome, intervals, samples_file, output_vcf_file):
+    """
+    Extracts all the (merged) intervals of one chromosome from the remote VCF
+    in a single bcftools view call, and indexes the result so that the
+    per-rsID regions can then be split out locally.
+    The region list is streamed to bcftools on stdin, no temporary file is written.
+    """
+    print(f"\n--- Step 3: Extracting {len(intervals)} interval(s) of chromosome {chromosome} with bcftools ---")
+    # Note: vcf_url_for_chr is specific to the chromosome being processed
+    print(f"  VCF source (GRCh37): {vcf_url_for_chr}")
+    print(f"  Target samples: {samples_file}")
+    print(f"  Output file: {output_vcf_file}")
+
+    # Ensure output directory exists
+    os.makedirs(os.path.dirname(output_vcf_file), exist_ok=True)
+
+    command = [
+        bcftools_cmd,
+        "view",
+        "--threads", str(BCFTOOLS_THREADS),
+        vcf_url_for_chr, # Use the dynamically generated URL passed to this function
+        "-R", "/dev/stdin", # Region list sent on stdin (see format_regions)
+        "-S", samples_file,
+        "-O", "b",         # Output compressed BCF (intermediate file, no text serialization)
+        "-o", output_vcf_file
+    ]
+    if not run_bcftools_command(bcftools_cmd, command, f"chromosome {chromosome} regions", vcf_url_for_chr,
+                                samples_file, input_text=format_regions(chromosome, intervals)):
+        return False
+
+    # Index the local extraction so that 'bcftools view -r' can split it
+    # (BCF files are indexed with a .csi index)
+    index_command = [bcftools_cmd, "index", "--threads", str(BCFTOOLS_THREADS), "-c", "-f", output_vcf_file]
+    return run_bcftools_command(bcftools_cmd, index_command, f"indexing {output_vcf_file}", output_vcf_file)
+
+
+def run_bcftools(bcftools_cmd, vcf_source, region, output_vcf_file):
+    """
+    Runs the bcftools view command for a specific region of an (indexed)
+    VCF/BCF file, e.g. to split one rsID window out of a per-chromosome extraction.
+    The output is a compressed text VCF, as read by the downstream scripts.
+    """
+    print(f"  Splitting region {region} -> {output_vcf_file}")
+
+    command = [
+        bcftools_cmd,
+        "view",
+        "--threads", str(BCFTOOLS_THREADS),
+        vcf_source,
+        "-r", region,
+        "-O", "z",         # Output compressed VCF
+        "-o", output_vcf_file
+    ]
+
+    # Ensure output directory exists
+    os.makedirs(os.path.dirname(output_vcf_file), exist_ok=True)
+
+    return run_bcftools_command(bcftools_cmd, command, f"region {region}", vcf_source)
+
+def chromosome_vcf_source(chromosome_cleaned):
+    """
+    Returns (remote VCF URL, bcftools source) for a chromosome.
+    The source points bcftools at the locally cached index (htslib '##idx##' syntax)
+    instead of letting it fetch the remote .tbi again.
+    """
+    # --- Dynamically create the VCF URL for the current chromosome ---
+    vcf_filename_on_server = VCF_FILENAME_TEMPLATE.replace("{CHROMOSOME}", chromosome_cleaned)
+    dynamic_vcf_url = BASE_VCF_FTP_PATH + vcf_filename_on_server
+    # --- End of dynamic URL creation ---
+
+    local_index = fetch_remote_index(dynamic_vcf_url, INDEX_CACHE_DIR)
+    if local_index:
+        return dynamic_vcf_url, f"{dynamic_vcf_url}##idx##{local_index}"
+    return dynamic_vcf_url, dynamic_vcf_url
+
+
+def run_bcftools_stream(bcftools_cmd, vcf_source, chromosome, intervals, samples_file, stdout=subprocess.PIPE):
+    """
+    Starts bcftools view on the given intervals of one chromosome and returns the
+    running process, which writes an uncompressed BCF stream (-O u) to stdout:
+    a downstream tool (e.g. 'bcftools annotate -', 'plink2 --bcf /dev/stdin')
+    can read it directly, without a BGZF compression/decompression round-trip
+    through a file on disk.
+    With the default stdout=subprocess.PIPE, the stream is read from proc.stdout;
+    pass a file object or descriptor to write it there instead.
+    """
+    command = [
+        bcftools_cmd,
+        "view",
+        "--threads", str(BCFTOOLS_THREADS),
+        vcf_source,
+        "-R", "/dev/stdin", # Region list sent on stdin (see format_regions)
+        "-S", samples_file,
+        "-O", "u",         # Output uncompressed BCF
+        "-o", "-"          # ... to stdout
+    ]
+    try:
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=stdout, text=False)
+    except FileNotFoundError:
+        print(f"ERROR: bcftools command '{bcftools_cmd}' not found.", file=sys.stderr)
+        print("  Please ensure bcftools is installed and the path in BCFTOOLS_CMD is correct.", file=sys.stderr)
+        sys.exit(1)
+    # bcftools reads the whole region list before producing any output.
+    # If it exits early (bad samples file, unreachable index...), the pipe is closed:
+    # its exit status and stderr are then the diagnostic, returned through proc.
+    try:
+        proc.stdin.write(format_regions(chromosome, intervals).encode())
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    return proc
+
+
+def stream_main(chromosome_cleaned):
+    """
+    Streaming mode ('--stream CHROMOSOME'): writes the merged regions of one
+    chromosome as uncompressed BCF to stdout, for piping into the next tool, e.g.
+        python script/02_get_SNP_data.py --stream 3 | bcftools annotate ... -
+    All progress messages go to stderr to keep stdout a clean BCF stream.
+    Returns the exit status of bcftools.
+    """
+    with contextlib.redirect_stdout(sys.stderr):
+        extract_samples(PANEL_FILE_LOCAL, POPULATION_CODE, SAMPLES_FILE)
+        try:
+            regions, _ = load_regions(REGIONS_FILE_TSV)
+        except FileNotFoundError:
+            print(f"ERROR: Regions TSV file '{REGIONS_FILE_TSV}' not found!")
+            sys.exit(1)
+        except Exception as e:
+            print(f"ERROR: Failed to read or process regions TSV file '{REGIONS_FILE_TSV}': {e}")
+            sys.exit(1)
+        regions = regions[regions["chr_c"] == chromosome_cleaned]
+        if regions.empty:
+            print(f"ERROR: No valid regions for chromosome {chromosome_cleaned} in '{REGIONS_FILE_TSV}'.")
+            sys.exit(1)
+        merged = merge_intervals(zip(regions["start"], regions["end"]))
+        _, vcf_source = chromosome_vcf_source(chromosome_cleaned)
+        print(f"Streaming {len(merged)} interval(s) of chromosome {chromosome_cleaned} as uncompressed BCF...")
+
+    # bcftools writes straight to this script's stdout
+    sys.stdout.flush()
+    proc = run_bcftools_stream(BCFTOOLS_CMD, vcf_source, chromosome_cleaned, merged, SAMPLES_FILE,
+                               stdout=sys.stdout.fileno())
+    returncode = proc.wait()
+    if returncode != 0:
+        # bcftools has already printed its own error messages on stderr
+        print(f"ERROR: bcftools failed for chromosome {chromosome_cleaned} (Return Code: {returncode}).", file=sys.stderr)
+    return returncode
+
+
+def process_chromosome(chromosome_cleaned, regions):
+    """
+    Fetches all the regions of one chromosome from the remote VCF and splits
+    them into one VCF per rsID.
+    regions is a list of (start, end, region_str, output_filename) tuples.
+    Returns (successful_extractions, failed_regions) for this chromosome.
+    """
+    successful_extractions = []
+    failed_regions = []
+
+    dynamic_vcf_url, vcf_source = chromosome_vcf_source(chromosome_cleaned)
+
+    # Overlapping windows are merged so that the remote BGZF blocks are only
+    # downloaded and decoded once, then each rsID window is split locally
+    merged = merge_intervals((start, end) for start, end, _, _ in regions)
+    chromosome_vcf = os.path.join(
+        CHROMOSOME_DIR, f"chr{chromosome_cleaned}_GRCh37_{POPULATION_CODE}_regions.bcf"
+    )
+    print(f"\nChromosome {chromosome_cleaned}: {len(regions)} regions merged into {len(merged)} interval(s).")
+
+    if not fetch_chromosome_regions(BCFTOOLS_CMD, vcf_source, chromosome_cleaned, merged, SAMPLES_FILE, chromosome_vcf):
+        for _, _, region_str, _ in regions:
+            failed_regions.append(f"{region_str} (Source: {dynamic_vcf_url})") # Add more context on failure
+        return successful_extractions, failed_regions
+
+    # Split the per-rsID windows out of the local per-chromosome extraction
+    for _, _, region_str, output_filename in regions:
+        if run_bcftools(BCFTOOLS_CMD, chromosome_vcf, region_str, output_filename):
+             successful_extractions.append(output_filename)
+        else:
+             failed_regions.append(f"{region_str} (Source: {chromosome_vcf})")
+
+    return successful_extractions, failed_regions
+
+def load_regions(regions_file):
+    """
+    Loads the regions TSV (columns Chromosome, Position_GRCh37 and optionally rsID)
+    and computes the window, region string and output file name of every row at once.
+    Returns (regions DataFrame, list of (row_number, row) for the invalid rows).
+    """
+    # Read everything as text: the coordinates file contains 'NA'/'PARSE_ERROR' for unresolved rsIDs.
+    # As with the previous csv.reader loop, only the header columns are used: the python
+    # engine with index_col=False drops extra trailing fields (e.g. a trailing tab) instead
+    # of shifting the columns or aborting, and short rows are padded (then reported as invalid).
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", pd.errors.ParserWarning)
+        df = pd.read_csv(regions_file, sep="\t", dtype=str, keep_default_na=False,
+                         index_col=False, engine="python")
+    df = df.fillna("")
+
+    missing = [col for col in ("Chromosome", "Position_GRCh37") if col not in df.columns]
+    if missing:
+        print(f"ERROR: Missing expected column in regions TSV file header: {missing}")
+        print(f"Expected columns like 'Chromosome' and 'Position_GRCh37'. Found: {list(df.columns)}")
+        sys.exit(1)
+
+    # Optional: Get rsID for naming output files
+    if "rsID" not in df.columns:
+        df["rsID"] = [f"region_{i+1}" for i in range(len(df))]
+
+    # Only plain integer positions are valid (rejects 'NA', 'inf', '12.7', '1e4'...)
+    position_text = df["Position_GRCh37"].str.strip()
+    invalid = ~position_text.str.fullmatch(r"\d+").astype(bool) | (df["Chromosome"] == "")
+    # Row numbers as in the file (header is line 1)
+    invalid_rows = [(i + 2, row) for i, row in zip(df.index[invalid], df[invalid].values.tolist())]
+
+    df = df[~invalid].copy()
+    position = position_text[~invalid].astype("int64")
+
+    # Handle potential 'chr' prefix if needed, although 1000G usually uses just numbers/X/Y/MT
+    df["chr_c"] = df["Chromosome"].str.removeprefix("chr")
+    # Define the region boundaries
+    df["start"] = (position - REGION_WINDOW_SIZE).clip(lower=1) # Ensure start is not negative
+    df["end"] = position + REGION_WINDOW_SIZE
+    # bcftools usually expects e.g. '1' not 'chr1'
+    df["region"] = df["chr_c"] + ":" + df["start"].astype(str) + "-" + df["end"].astype(str)
+    # Define the output file name (use original chromosome string from TSV for clarity)
+    df["output_filename"] = (
+        OUTPUT_DIR + os.sep + df["rsID"] + "_chr" + df["Chromosome"] + "_"
+        + df["start"].astype(str) + "_" + df["end"].astype(str)
+        + f"_GRCh37_{POPULATION_CODE}_subset.vcf.gz"
+    )
+    return df, invalid_rows
+
 # === Main Script Execution ===
 
 def main():
@@ -160,61 +503,7 @@ def main():
     failed_regions = []
 
     try:
-        with open(REGIONS_FILE_TSV, 'r', newline='') as tsvfile:
-            reader = csv.reader(tsvfile, delimiter='\t')
-            header = next(reader) # Read header row
-
-            # Find column indices dynamically
-            try:
-                chr_col_idx = header.index("Chromosome")
-                pos_col_idx = header.index("Position_GRCh37")
-                # Optional: Get rsID for naming output files
-                rsid_col_idx = header.index("rsID") if "rsID" in header else -1
-            except ValueError as e:
-                print(f"ERROR: Missing expected column in regions TSV file header: {e}")
-                print(f"Expected columns like 'Chromosome' and 'Position_GRCh37'. Found: {header}")
-                sys.exit(1)
-
-            # Process each row (region) from the TSV
-            for i, row in enumerate(reader):
-                try:
-                    chromosome = row[chr_col_idx]
-                    # Handle potential 'chr' prefix if needed, although 1000G usually uses just numbers/X/Y/MT
-                    chromosome_cleaned = chromosome.replace('chr', '')
-                    position = int(row[pos_col_idx])
-                    rsid = row[rsid_col_idx] if rsid_col_idx != -1 else f"region_{i+1}"
-
-                    # Define the region boundaries
-                    start_pos = max(1, position - REGION_WINDOW_SIZE) # Ensure start is not negative
-                    end_pos = position + REGION_WINDOW_SIZE
-                    # Use the cleaned chromosome for region string if needed by bcftools, but original for filename likely
-                    region_str = f"{chromosome_cleaned}:{start_pos}-{end_pos}" # bcftools usually expects e.g. '1' not 'chr1'
-
-                    # --- Dynamically create the VCF URL for the current chromosome ---
-                    vcf_filename_on_server = VCF_FILENAME_TEMPLATE.replace("{CHROMOSOME}", chromosome_cleaned)
-                    dynamic_vcf_url = BASE_VCF_FTP_PATH + vcf_filename_on_server
-                    # --- End of dynamic URL creation ---
-
-                    # Define the output file name (use original chromosome string from TSV for clarity)
-                    output_filename = os.path.join(
-                        OUTPUT_DIR,
-                        f"{rsid}_chr{chromosome}_{start_pos}_{end_pos}_GRCh37_{POPULATION_CODE}_subset.vcf.gz"
-                    )
-
-                    # Run bcftools for this region using the dynamically constructed URL
-                    if run_bcftools(BCFTOOLS_CMD, dynamic_vcf_url, region_str, SAMPLES_FILE, output_filename):
-                         successful_extractions.append(output_filename)
-                    else:
-                         failed_regions.append(f"{region_str} (Source: {dynamic_vcf_url})") # Add more context on failure
-
-                except (IndexError, ValueError) as e:
-                    print(f"WARNING: Skipping invalid row {i+2} in {REGIONS_FILE_TSV}: {row}. Error: {e}")
-                    failed_regions.append(f"Row {i+2} (Invalid Data: {row})")
-                except Exception as e:
-                    print(f"WARNING: An unexpected error occurred processing row {i+2} ({row}) from {REGIONS_FILE_TSV}: {e}")
-                    failed_regions.append(f"Row {i+2} (Processing Error: {row})")
-
-
+        regions, invalid_rows = load_regions(REGIONS_FILE_TSV)
     except FileNotFoundError:
         print(f"ERROR: Regions TSV file '{REGIONS_FILE_TSV}' not found during processing!")
         sys.exit(1)
@@ -222,8 +511,33 @@ def main():
         print(f"ERROR: Failed to read or process regions TSV file '{REGIONS_FILE_TSV}': {e}")
         sys.exit(1)
 
+    row_count = len(regions) + len(invalid_rows)
+    for row_number, row in invalid_rows:
+        print(f"WARNING: Skipping invalid row {row_number} in {REGIONS_FILE_TSV}: {row}.")
+        failed_regions.append(f"Row {row_number} (Invalid Data: {row})")
+
+    # Regions grouped by chromosome: {chromosome_cleaned: [(start, end, region_str, output_filename), ...]}
+    regions_by_chromosome = {
+        chromosome_cleaned: list(group[["start", "end", "region", "output_filename"]].itertuples(index=False, name=None))
+        for chromosome_cleaned, group in regions.groupby("chr_c", sort=False)
+    }
+
+    # Fetch each chromosome once, several chromosomes in parallel
+    print(f"\nFetching {len(regions_by_chromosome)} chromosome(s) with up to {MAX_PARALLEL_DOWNLOADS} parallel downloads...")
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_DOWNLOADS) as executor:
+        futures = {
+            executor.submit(process_chromosome, chromosome_cleaned, regions): chromosome_cleaned
+            for chromosome_cleaned, regions in regions_by_chromosome.items()
+        }
+        for future in as_completed(futures):
+            chromosome_successes, chromosome_failures = future.result()
+            print(f"Chromosome {futures[future]} done: {len(chromosome_successes)} VCF(s) created, {len(chromosome_failures)} failure(s).")
+            successful_extractions.extend(chromosome_successes)
+            failed_regions.extend(chromosome_failures)
+
     print("\n--- Optional Cleanup ---")
     print(f"Sample ID file ({SAMPLES_FILE}) kept.")
+    print(f"Per-chromosome extractions ({CHROMOSOME_DIR}) kept.")
     # If you want to remove the sample file after completion, uncomment the next line:
     # try:
     #     os.remove(SAMPLES_FILE)
@@ -233,7 +547,7 @@ def main():
 
 
     print("\n=== SCRIPT FINISHED ===")
-    print(f"Attempted to process {i+1} regions from TSV.") # i is the index from enumerate starting at 0
+    print(f"Attempted to process {row_count} regions from TSV.")
     print(f"Successfully created VCFs ({len(successful_extractions)}):")
     # Optional: print list of successful files if needed
     # for fname in successful_extractions:
@@ -247,4 +561,7 @@ def main():
         print("\nAll regions processed successfully (check bcftools output above for details on empty regions).")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) == 3 and sys.argv[1] == "--stream":
+        sys.exit(stream_main(sys.argv[2].removeprefix("chr")))
+    else:
+        main()